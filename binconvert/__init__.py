@@ -1,2 +1,2 @@
 __version__ = '0.1.2'
-from convert import convert
+from .convert import Converter, convert
@@ -0,0 +1,53 @@
+"""
+Optional numba kernels for byte swapping. Importing this module raises
+ImportError when numba is not installed.
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def _swap2(a):
+    for i in prange(a.shape[0]):
+        for j in range(a.shape[1]):
+            x = a[i, j]
+            a[i, j] = (x << np.uint16(8)) | (x >> np.uint16(8))
+
+
+@njit(parallel=True, cache=True)
+def _swap4(a):
+    for i in prange(a.shape[0]):
+        for j in range(a.shape[1]):
+            x = a[i, j]
+            x = (((x & np.uint32(0x00FF00FF)) << np.uint32(8)) |
+                 ((x >> np.uint32(8)) & np.uint32(0x00FF00FF)))
+            a[i, j] = (x << np.uint32(16)) | (x >> np.uint32(16))
+
+
+@njit(parallel=True, cache=True)
+def _swap8(a):
+    for i in prange(a.shape[0]):
+        for j in range(a.shape[1]):
+            x = a[i, j]
+            x = (((x & np.uint64(0x00FF00FF00FF00FF)) << np.uint64(8)) |
+                 ((x >> np.uint64(8)) & np.uint64(0x00FF00FF00FF00FF)))
+            x = (((x & np.uint64(0x0000FFFF0000FFFF)) << np.uint64(16)) |
+                 ((x >> np.uint64(16)) & np.uint64(0x0000FFFF0000FFFF)))
+            a[i, j] = (x << np.uint64(32)) | (x >> np.uint64(32))
+
+
+_KERNELS = {2: _swap2, 4: _swap4, 8: _swap8}
+
+
+def byteswap(a):
+    """
+    Reverse the bytes of every item of an unsigned integer array in place.
+
+    Parameters
+    ----------
+    a : numpy.ndarray
+        1-D or 2-D array of uint16, uint32 or uint64 to swap.
+    """
+    if a.ndim == 1:
+        a = a[:, np.newaxis]
+    _KERNELS[a.itemsize](a)
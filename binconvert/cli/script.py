@@ -1,14 +1,12 @@
 from __future__ import print_function
 
-import argparse
 import os
 import struct
 import sys
-import yaml
 
 import binconvert
 from binconvert import convert
-from binconvert.utils import (gen_format_string, write_to_config_file,
+from binconvert.utils import (gen_format_records, write_to_config_file,
                               read_from_config_file)
 
 
@@ -16,6 +14,13 @@ def main():
     """
     CLI script for convert function.
     """
+    # Handle the version switch before importing argparse so it returns fast.
+    if sys.argv[1:] in (['-v'], ['--version']):
+        print(binconvert.__version__)
+        sys.exit()
+
+    import argparse
+
     description = 'Convert files from one byte order to another.'
     parser = argparse.ArgumentParser(prog='bconv', description=description)
     parser.add_argument('source', nargs='?', help='Path to input file')
@@ -127,18 +132,21 @@ def main():
             # Do this in case default config file is corrupted or doesn't exist.
             formats = ['h:#']
 
-    # Finally we can generate the full format string
+    # Finally we can check the formats against the source file. The full
+    # format string is never needed, since convert works from the records.
+    # Note that the pound count is expanded in place if requested.
     try:
-        fmt, expanded_formats = gen_format_string(formats, size, args.expand)
+        gen_format_records(formats, size, args.expand)
     except struct.error as e:
         parser.error(e)
 
     # Store default format in config file
-    if args.store or (args.format is None and expanded_formats != formats):
-        write_to_config_file(configfile, expanded_formats)
+    if args.store:
+        write_to_config_file(configfile, formats)
 
     # Print the format string
     if args.printf:
+        import yaml
         print(yaml.dump({'Current Formats': formats},
                         default_flow_style=False)[:-1])
 
@@ -148,7 +156,7 @@ def main():
 
     # Do the actual byte order conversion.
     try:
-        convert(source, destination, byte_order, fmt)
+        convert(source, destination, byte_order, formats)
     except IOError as e:
         # source input file can't be read
         parser.error(e)
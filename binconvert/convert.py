@@ -1,9 +1,491 @@
+import array
+import functools
+import mmap
 import os
+import re
+import shutil
 import struct
 import sys
+import warnings
 
+from .utils import gen_format_records
 
-def convert(source, destination=None, byte_order=None, fmt=None):
+# Number of bytes to swap at a time when streaming through a file.
+CHUNKSIZE = 8*1024*1024
+
+# Matches a single (count, type code) pair of a struct format string.
+_FORMAT_RE = re.compile(r'(\d*)(\D)')
+
+# Unsigned array type codes keyed by their item size on this platform.
+_ARRAY_TYPECODES = {}
+for _typecode in 'QLIH':
+    try:
+        _ARRAY_TYPECODES[array.array(_typecode).itemsize] = _typecode
+    except ValueError:
+        # 'Q' is not available on Python 2.
+        pass
+
+# numpy is slow to import, so it is only loaded by the first conversion. This
+# is None until then, and False when numpy is not installed.
+_numpy = None
+
+
+def _get_numpy():
+    """
+    Return the numpy module, or None when it is not installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy = False
+
+    return _numpy or None
+
+
+def _add_span(spans, span):
+    """
+    Append span to spans, merging it into the last span when the two form a
+    single contiguous run of same sized items.
+    """
+    offset, itemsize, num, count, stride = span
+
+    # Rows that directly follow each other are just one long row.
+    if count == 1 or stride == itemsize*num:
+        num, count = num*count, 1
+        stride = itemsize*num
+
+    if spans and count == 1:
+        last_offset, last_itemsize, last_num, last_count, _ = spans[-1]
+        if (last_count == 1 and last_itemsize == itemsize and
+                last_offset + itemsize*last_num == offset):
+            num += last_num
+            spans[-1] = (last_offset, itemsize, num, 1, itemsize*num)
+            return
+
+    spans.append((offset, itemsize, num, count, stride))
+
+
+def _parse_format(fmt):
+    """
+    Break a struct format string into the runs of bytes that need swapping.
+
+    Parameters
+    ----------
+    fmt : str
+        Format string without a leading byte order character.
+
+    Returns
+    -------
+    size : int
+        The total size in bytes described by fmt.
+    spans : list of tuple
+        A list of (offset, itemsize, num, count, stride) tuples, one for each
+        run of count rows of num contiguous items of itemsize bytes, where the
+        first row starts at offset and the rows are stride bytes apart. A run
+        within fmt is always a single row. Items that are only one byte wide
+        (eg, strings and chars) are left out since they are never swapped.
+    """
+    fmt = ''.join(fmt.split())
+    if fmt and fmt[-1].isdigit():
+        raise struct.error('repeat count given without format specifier')
+
+    spans = []
+    offset = 0
+    for count, code in _FORMAT_RE.findall(fmt):
+        count = int(count) if count else 1
+        itemsize = struct.calcsize('<' + code)
+
+        # For strings the count is the length of the string in bytes.
+        if code in 'sp':
+            offset += count
+            continue
+
+        if itemsize > 1 and count:
+            _add_span(spans, (offset, itemsize, count, 1, itemsize*count))
+
+        offset += itemsize*count
+
+    return offset, spans
+
+
+def _parse_records(records):
+    """
+    Break a list of (pattern, count) records into the runs of bytes that need
+    swapping. Each run of a repeated pattern becomes a single run of count
+    rows, one per record, so the number of runs does not grow with the count
+    or with the length of the run.
+
+    Returns
+    -------
+    size : int
+        The total size in bytes described by records.
+    spans : list of tuple
+        A list of (offset, itemsize, num, count, stride) tuples as returned by
+        _parse_format.
+    """
+    spans = []
+    size = 0
+    for pattern, count in records:
+        record_size, record_spans = _parse_format(pattern)
+
+        # Repeats of a uniform pattern end up as one long contiguous row.
+        if count:
+            for offset, itemsize, num, _, _ in record_spans:
+                _add_span(spans, (size + offset, itemsize, num, count,
+                                  record_size))
+
+        size += record_size*count
+
+    return size, spans
+
+
+def _uniform_itemsize(size, spans):
+    """
+    Return the item size if spans cover all size bytes with a single run of
+    same sized items, otherwise None.
+    """
+    if len(spans) == 1:
+        offset, itemsize, num, count, _ = spans[0]
+        if offset == 0 and count == 1 and size == itemsize*num:
+            return itemsize
+
+
+def _same_file(source, destination):
+    """
+    Check whether source and destination refer to the same file.
+    """
+    if os.path.exists(destination) and hasattr(os.path, 'samefile'):
+        return os.path.samefile(source, destination)
+
+    return os.path.abspath(source) == os.path.abspath(destination)
+
+
+def _swap_numpy(path, spans, threads=None, use_numba=False):
+    """
+    Byte swap the given runs of the file at path in place using numpy.
+
+    The file is memory mapped and swapped CHUNKSIZE bytes at a time, so only
+    the pages being worked on need to be resident in memory. Chunks are
+    independent of each other, so they are spread over a pool of threads
+    when there is more than one of them.
+    """
+    # Split every run into (offset, itemsize, num, count, stride) chunks of
+    # work, splitting single long rows into rows of one item first.
+    chunks = []
+    for offset, itemsize, num, count, stride in spans:
+        if count == 1:
+            num, count, stride = 1, num, itemsize
+
+        step = max(CHUNKSIZE // stride, 1)
+        for start in range(0, count, step):
+            chunks.append((offset + start*stride, itemsize, num,
+                           min(step, count - start), stride))
+
+    # An empty file cannot be memory mapped, and has nothing to swap anyway.
+    if not chunks:
+        return
+
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    np = _get_numpy()
+
+    # numba is slow to import and compile, so it is only loaded on request.
+    if use_numba:
+        from . import _numba
+
+    # The numba kernels already run in parallel, so by default they do not
+    # need a pool.
+    if threads is None:
+        threads = 1 if use_numba else multiprocessing.cpu_count()
+    threads = min(threads, len(chunks))
+
+    with open(path, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0)
+
+    def swap_chunk(chunk):
+        offset, itemsize, num, count, stride = chunk
+
+        # Rows of several items are a 2-D view. Rows of a single item are
+        # kept 1-D, which numpy can cast in place without a temporary copy.
+        if num == 1:
+            shape, strides = (count,), (stride,)
+        else:
+            shape, strides = (count, num), (stride, itemsize)
+        data = np.ndarray(shape, 'u{0}'.format(itemsize), buffer=mm,
+                          offset=offset, strides=strides)
+        if use_numba:
+            _numba.byteswap(data)
+        else:
+            # Unlike ndarray.byteswap, casting from the opposite byte order
+            # releases the GIL, so the chunks really are swapped in parallel.
+            data[...] = data.view(data.dtype.newbyteorder())
+
+    try:
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                pool.map(swap_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                swap_chunk(chunk)
+        mm.flush()
+    finally:
+        mm.close()
+
+
+def _stream(source, destination, segments):
+    """
+    Rewrite source into destination one block at a time, in place when they
+    are the same file.
+
+    Parameters
+    ----------
+    segments : list of tuple
+        A list of (length, blocksize, func) tuples covering the file in order.
+        Each length bytes are read in blocks of at most blocksize bytes, and
+        func(block) is written out in place of every block.
+    """
+    same = _same_file(source, destination)
+    fin = open(source, 'r+b' if same else 'rb')
+    try:
+        fout = fin if same else open(destination, 'wb')
+        try:
+            position = 0
+            for length, blocksize, func in segments:
+                end = position + length
+                while position < end:
+                    fin.seek(position)
+                    block = fin.read(min(blocksize, end - position))
+                    if not block:
+                        break
+
+                    data = func(block)
+                    if same:
+                        fout.seek(position)
+                    fout.write(data)
+                    position += len(block)
+        finally:
+            if fout is not fin:
+                fout.close()
+    finally:
+        fin.close()
+
+
+def _swap_array(source, destination, size, typecode):
+    """
+    Byte swap a file of uniform items CHUNKSIZE bytes at a time using array.
+    """
+    def swap_block(block):
+        data = array.array(typecode, block)
+        data.byteswap()
+        return data
+
+    itemsize = array.array(typecode).itemsize
+    blocksize = max(CHUNKSIZE // itemsize, 1)*itemsize
+    _stream(source, destination, [(size, blocksize, swap_block)])
+
+
+def _swap_slices(source, destination, size, itemsize):
+    """
+    Byte swap a file of uniform items CHUNKSIZE bytes at a time using only
+    extended slices, for item sizes that array has no type code for.
+    """
+    def swap_block(block):
+        # Byte j of every item comes from byte itemsize - 1 - j of the same
+        # item, so each block takes itemsize slice assignments in C.
+        data = bytearray(len(block))
+        for j in range(itemsize):
+            data[j::itemsize] = block[itemsize - 1 - j::itemsize]
+        return data
+
+    blocksize = max(CHUNKSIZE // itemsize, 1)*itemsize
+    _stream(source, destination, [(size, blocksize, swap_block)])
+
+
+def _swap_lanes(data, block, spans, record_size):
+    """
+    Byte swap every record in block into data with extended slices, given the
+    spans of a single record as returned by _parse_format. data must be a
+    bytearray holding a copy of block, so that bytes outside the spans (eg,
+    strings and pad bytes) are passed through unchanged.
+    """
+    for offset, itemsize, num, _, _ in spans:
+        for start in range(offset, offset + itemsize*num, itemsize):
+            # Byte j of this field in every record comes from byte
+            # itemsize - 1 - j of the same field.
+            for j in range(itemsize):
+                data[start + j::record_size] = \
+                    block[start + itemsize - 1 - j::record_size]
+
+    return data
+
+
+class Converter(object):
+    """
+    Converts many files with a common format from one byte order to another.
+    The format is parsed once for each file size seen, and the buffer used to
+    swap blocks of records when numpy is not available is reused between
+    files. For example,
+
+    >>> converter = Converter(['4s7s10s10s', '4si2f:#'], 'little')
+    >>> for path in ['a.bin', 'b.bin', 'c.bin']:
+    ...     converter.convert(path)
+
+    converts each file in place to little endian.
+
+    Parameters
+    ----------
+    fmt : str or list of str, optional
+        Format string or list of format patterns. See convert for details.
+    byte_order : {None, 'little', 'big'}
+        The byte order to convert to (endianness). See convert for details.
+        Swapping bytes is the same operation in either direction, so this is
+        only kept as the byte_order attribute and does not change the result.
+    threads : int, optional
+        Number of threads used to swap large files when numpy is available.
+    use_numba : bool, optional
+        If True, swap with compiled numba kernels instead of numpy. See
+        convert for details.
+    """
+    # Maximum number of file sizes to keep parsed layouts for.
+    layout_cache_size = 128
+
+    def __init__(self, fmt=None, byte_order=None, threads=None,
+                 use_numba=False):
+        # Set default byte order to native
+        if byte_order is None:
+            byte_order = sys.byteorder
+
+        self.fmt = fmt
+        self.byte_order = byte_order
+        self.threads = threads
+        self.use_numba = use_numba
+        self._layouts = {}
+        self._buf = bytearray()
+
+    def _get_layout(self, num):
+        """
+        Return the (records, size, spans) describing a file of num bytes.
+        """
+        if num not in self._layouts:
+            if len(self._layouts) >= self.layout_cache_size:
+                self._layouts.clear()
+
+            # These records give the number of bytes and type for each piece
+            # of data in the file. The default swaps each even and odd byte,
+            # which is just one long run of shorts, so there is no need to
+            # build "Nh" and parse it.
+            if self.fmt is None:
+                records = [('h', num // 2)]
+            elif isinstance(self.fmt, (list, tuple)):
+                records, _ = gen_format_records(self.fmt, num)
+            else:
+                records = [(self.fmt, 1)]
+
+            size, spans = _parse_records(records)
+            self._layouts[num] = (records, size, spans)
+
+        return self._layouts[num]
+
+    def _swap_block(self, block, spans, record_size, blocksize):
+        """
+        Byte swap every record in block into the shared output buffer.
+        """
+        # Only full blocks use the shared buffer, so that the short last block
+        # of a file does not replace it before the next file is converted.
+        if len(block) != blocksize:
+            data = bytearray(block)
+        elif len(self._buf) == blocksize:
+            data = self._buf
+            data[:] = block
+        else:
+            data = self._buf = bytearray(block)
+
+        return _swap_lanes(data, block, spans, record_size)
+
+    def _swap_records(self, source, destination, records):
+        """
+        Convert a file one block of records at a time without numpy.
+
+        Records are swapped with one extended slice assignment per byte of
+        each field, using the (offset, itemsize) table of a single record, so
+        the work per block does not grow with the number of records. Bytes
+        that are not part of a multi-byte item are copied unchanged, just as
+        on the numpy path.
+        """
+        segments = []
+        for pattern, count in records:
+            record_size, spans = _parse_format(pattern)
+            if not (record_size and count):
+                continue
+
+            blocksize = max(CHUNKSIZE // record_size, 1)*record_size
+            swap_block = functools.partial(self._swap_block, spans=spans,
+                                           record_size=record_size,
+                                           blocksize=blocksize)
+            segments.append((record_size*count, blocksize, swap_block))
+
+        _stream(source, destination, segments)
+
+    def convert(self, source, destination=None):
+        """
+        Converts the given file (specified by source). See convert for details.
+
+        Parameters
+        ----------
+        source : str
+            The path to the binary file to be converted.
+        destination : str, optional
+            The path to the converted output file. If not specified, source is
+            overwritten.
+        """
+        # Set default destination path to source (overwrite)
+        if destination is None:
+            destination = source
+
+        num = os.path.getsize(source)
+        records, size, spans = self._get_layout(num)
+        if size != num:
+            raise struct.error('unpack requires a buffer of {0} bytes'
+                               .format(size))
+
+        # Items that are a single byte wide look the same in either byte order.
+        if not spans:
+            warnings.warn('{0} contains no multi-byte items, so there is '
+                          'nothing to convert.'.format(source))
+            if not _same_file(source, destination):
+                shutil.copyfile(source, destination)
+            return
+
+        # Swapping the bytes of each item is the same operation in either
+        # direction, so numpy can do it in bulk without unpacking anything.
+        if _get_numpy() is not None:
+            if not _same_file(source, destination):
+                shutil.copyfile(source, destination)
+            _swap_numpy(destination, spans, self.threads, self.use_numba)
+            return
+
+        # Without numpy, uniform files can still be swapped in C by array,
+        # or with extended slices when array has no type code of that size.
+        itemsize = _uniform_itemsize(size, spans)
+        if itemsize in _ARRAY_TYPECODES:
+            _swap_array(source, destination, size, _ARRAY_TYPECODES[itemsize])
+            return
+        elif itemsize is not None:
+            _swap_slices(source, destination, size, itemsize)
+            return
+
+        self._swap_records(source, destination, records)
+
+
+def convert(source, destination=None, byte_order=None, fmt=None, threads=None,
+            use_numba=False):
     """
     Converts the given file (specified by source) from one byte order
     to another. For example, to convert a file in the current working directory
@@ -34,40 +516,27 @@ def convert(source, destination=None, byte_order=None, fmt=None):
         "Do nothing" conversion operations are not allowed, so the input file
         given by source will be assumed to be formatted in the opposite
         byte order.
-    fmt : str, optional
+    fmt : str or list of str, optional
         Format string. See documentation for the python struct module for
         valid examples. The string should span the entire size of the file you
         are converting. The default format is "Nh", where N is half the size of
         the file in bytes, swapping each even and odd byte. For this case, the
-        total size of the file in bytes must be even.
+        total size of the file in bytes must be even. A list of format
+        patterns of the form ["<pattern1>:<count1>", ...] as accepted by
+        binconvert.utils.gen_format_string may be given instead, in which case
+        repeated patterns are converted record by record without building the
+        full format string.
+    threads : int, optional
+        Number of threads used to swap large files when numpy is available.
+        If not specified, the number of CPUs on your platform is used, or a
+        single thread when use_numba is set.
+    use_numba : bool, optional
+        If True, swap with compiled numba kernels instead of numpy. This
+        requires numba, and the kernels take a noticeable time to compile or
+        load on first use in each process, so it is off by default.
+
+    See Also
+    --------
+    Converter : Convert many files with a common format.
     """
-    # This format string gives the number of bytes and type
-    # for each piece of data in the record.
-    if fmt is None:
-        num = os.path.getsize(source)
-        fmt = '{0}h'.format(num/2)
-
-    # Set default destination path to source (overwrite)
-    if destination is None:
-        destination = source
-
-    # Set default byte order to native
-    if byte_order is None:
-        byte_order = sys.byteorder
-
-    # This tells the struct library the byte order when packing/unpacking
-    if byte_order == 'little':
-        fmt_in = '>{0}'.format(fmt)
-        fmt_out = '<{0}'.format(fmt)
-    else:
-        fmt_in = '<{0}'.format(fmt)
-        fmt_out = '>{0}'.format(fmt)
-
-    # Read and convert the data from source file
-    with open(source, 'rb') as f:
-        stream = f.read()
-        data = struct.unpack(fmt_in, stream)
-
-    # Write converted data to destination file
-    with open(destination, 'wb') as f:
-        f.write(struct.pack(fmt_out, *data))
+    Converter(fmt, byte_order, threads, use_numba).convert(source, destination)
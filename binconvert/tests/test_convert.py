@@ -1,8 +1,14 @@
-from .. import convert, utils
+from .. import Converter, convert, utils
 import os
 import struct
 import sys
 import unittest
+import warnings
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 class TestConvert(unittest.TestCase):
@@ -38,11 +44,12 @@ class TestConvert(unittest.TestCase):
             return struct.unpack(fmt, stream)
 
     def setUp(self):
+        self.module = sys.modules[convert.__module__]
         self.fmt = '3s3si3si'
         self.formats = ['3s', '3si:#']
         self.lsource = 'l.bin'
         self.bsource = 'b.bin'
-        self.content = ('foo', 'bar', 26, 'baz', 32)
+        self.content = (b'foo', b'bar', 26, b'baz', 32)
         self.gen_binary_file(self.lsource, *self.content,
                              byte_order='little')
         self.gen_binary_file(self.bsource, *self.content, byte_order='big')
@@ -65,11 +72,11 @@ class TestConvert(unittest.TestCase):
         else:
             test_byte_order = 'little'
 
-        self.gen_binary_file('test.bin', '\xab\xcd',
+        self.gen_binary_file('test.bin', b'\xab\xcd',
                              byte_order=test_byte_order, fmt='2s')
         convert('test.bin')
         result, = self.read_binary_file('test.bin', fmt='2s')
-        self.assertEqual('\xcd\xab', result)
+        self.assertEqual(b'\xcd\xab', result)
 
     def test_convert_big_to_little(self):
         """
@@ -89,6 +96,121 @@ class TestConvert(unittest.TestCase):
                                        fmt=self.fmt)
         self.assertEqual(self.content, result)
 
+    def test_convert_records(self):
+        """
+        Convert using a list of format patterns instead of a format string
+        """
+        convert(self.bsource, 'test.bin', byte_order='little',
+                fmt=self.formats)
+        result = self.read_binary_file('test.bin', byte_order='little',
+                                       fmt=self.fmt)
+        self.assertEqual(self.content, result)
+
+    def test_convert_repeated_records(self):
+        """
+        Convert a repeated pattern mixing strings and several item sizes
+        """
+        fmt = '2s2hiq2s2hiq2s2hiq'
+        content = (b'ab', 1, -2, 3, 4, b'cd', 5, 6, -7, 8,
+                   b'ef', 9, 10, 11, -12)
+        self.gen_binary_file('test.bin', *content, byte_order='big', fmt=fmt)
+        convert('test.bin', byte_order='little', fmt=['2s2hiq:#'])
+        result = self.read_binary_file('test.bin', byte_order='little',
+                                       fmt=fmt)
+        self.assertEqual(content, result)
+
+    def test_convert_small_chunks(self):
+        """
+        Convert in several chunks, with a chunk size that is not a multiple of
+        the item size, on two threads
+        """
+        chunksize = self.module.CHUNKSIZE
+        self.module.CHUNKSIZE = 7
+        try:
+            content = tuple(range(20))
+            self.gen_binary_file('test.bin', *content, byte_order='big',
+                                 fmt='20q')
+            convert('test.bin', byte_order='little', fmt='20q', threads=2)
+            result = self.read_binary_file('test.bin', byte_order='little',
+                                           fmt='20q')
+            self.assertEqual(content, result)
+
+            convert(self.bsource, 'test.bin', byte_order='little',
+                    fmt=self.formats, threads=2)
+            result = self.read_binary_file('test.bin', byte_order='little')
+            self.assertEqual(self.content, result)
+        finally:
+            self.module.CHUNKSIZE = chunksize
+
+    @unittest.skipIf(numba is None, 'numba is not installed')
+    def test_convert_numba(self):
+        """
+        The numba kernels give the same result as numpy on unaligned and
+        strided layouts
+        """
+        for fmt, size in [('hxhf', 9), (['2s2hiq:#'], 54)]:
+            with open('test.bin', 'wb') as f:
+                f.write(os.urandom(size))
+            convert('test.bin', self.lsource, fmt=fmt)
+            convert('test.bin', self.bsource, fmt=fmt, use_numba=True)
+            with open(self.lsource, 'rb') as f, open(self.bsource, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_converter_reuse(self):
+        """
+        Convert files of different sizes with a single Converter
+        """
+        converter = Converter(self.formats, byte_order='little')
+        converter.convert(self.bsource, 'test.bin')
+        result = self.read_binary_file('test.bin', byte_order='little')
+        self.assertEqual(self.content, result)
+
+        fmt = '3s3si3si3si'
+        content = self.content + (b'qux', 48)
+        self.gen_binary_file('test.bin', *content, byte_order='big', fmt=fmt)
+        converter.convert('test.bin')
+        result = self.read_binary_file('test.bin', byte_order='little',
+                                       fmt=fmt)
+        self.assertEqual(content, result)
+
+    def test_convert_empty(self):
+        """
+        Convert an empty file with the default format
+        """
+        with open('test.bin', 'wb'):
+            pass
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            convert('test.bin')
+            convert('test.bin', fmt=['h:#'])
+
+        self.assertEqual(0, os.path.getsize('test.bin'))
+
+    def test_convert_pad_bytes(self):
+        """
+        Bytes outside multi-byte items are passed through unchanged
+        """
+        with open('test.bin', 'wb') as f:
+            f.write(b'\x01\x02\xff\x03\x04\x7f\xa0\x00\x01')
+        convert('test.bin', byte_order='little', fmt='hxhf')
+        with open('test.bin', 'rb') as f:
+            self.assertEqual(b'\x02\x01\xff\x04\x03\x01\x00\xa0\x7f',
+                             f.read())
+
+    def test_convert_single_byte(self):
+        """
+        Formats with only single byte items are copied unchanged with a warning
+        """
+        fmt = '{0}s'.format(os.path.getsize(self.bsource))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            convert(self.bsource, 'test.bin', byte_order='little', fmt=fmt)
+
+        self.assertEqual(1, len(caught))
+        with open(self.bsource, 'rb') as f, open('test.bin', 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
     def test_gen_format_string_pound(self):
         """
         Calculate format string with pound
@@ -97,9 +219,81 @@ class TestConvert(unittest.TestCase):
                                          size=os.path.getsize(self.bsource))
         self.assertEqual('3s3si3si', fmt)
 
+    def test_gen_format_string_cached(self):
+        """
+        Repeated calls return the same results as the first one
+        """
+        for _ in range(2):
+            fmt, formats = utils.gen_format_string(('h', 'i'), size=6)
+            self.assertEqual('hi', fmt)
+            self.assertEqual(('h', 'i'), formats)
+
+        for _ in range(2):
+            formats = ['i', 'h:#']
+            fmt, result = utils.gen_format_string(formats, size=10,
+                                                  expand=True)
+            self.assertEqual('i3h', fmt)
+            self.assertEqual(['i', 'h:3'], result)
+            self.assertIs(formats, result)
+
     def test_gen_format_string_counts(self):
         """
         Calculate format string with counts given
         """
         fmt, _ = utils.gen_format_string(['i', '2sf:3', 'h'])
         self.assertEqual('i2sf2sf2sfh', fmt)
+
+    def test_convert_uniform(self):
+        """
+        Convert a file whose items all share the same size
+        """
+        content = (1.5, -2.25, 1e10)
+        self.gen_binary_file('test.bin', *content, byte_order='big', fmt='3d')
+        convert('test.bin', byte_order='little', fmt='3d')
+        result = self.read_binary_file('test.bin', byte_order='little',
+                                       fmt='3d')
+        self.assertEqual(content, result)
+
+    def test_gen_format_records(self):
+        """
+        Split format patterns into records with pound
+        """
+        records, special_index = utils.gen_format_records(
+            self.formats, size=os.path.getsize(self.bsource))
+        self.assertEqual([('3s', 1), ('3si', 2)], records)
+        self.assertEqual(1, special_index)
+
+    def test_gen_format_string_repeat_count(self):
+        """
+        Single type code patterns are repeated with a struct count
+        """
+        fmt, _ = utils.gen_format_string(['i', 'h:3', 'd:#'], size=26)
+        self.assertEqual('i3h2d', fmt)
+
+
+class TestConvertWithoutNumpy(TestConvert):
+    """
+    Run the conversion tests through the array and extended slice paths
+    """
+    def setUp(self):
+        super(TestConvertWithoutNumpy, self).setUp()
+        self.numpy = self.module._numpy
+        self.module._numpy = False
+
+    def tearDown(self):
+        self.module._numpy = self.numpy
+        super(TestConvertWithoutNumpy, self).tearDown()
+
+
+class TestConvertWithoutArray(TestConvertWithoutNumpy):
+    """
+    Run the conversion tests through the extended slice paths only
+    """
+    def setUp(self):
+        super(TestConvertWithoutArray, self).setUp()
+        self.typecodes = self.module._ARRAY_TYPECODES
+        self.module._ARRAY_TYPECODES = {}
+
+    def tearDown(self):
+        self.module._ARRAY_TYPECODES = self.typecodes
+        super(TestConvertWithoutArray, self).tearDown()
@@ -1,6 +1,43 @@
 import os
+import re
 import struct
-import yaml
+
+# Matches each "<pattern>:<count>" line of a newline separated formats list.
+_FORMATS_RE = re.compile(r'^([^:\n]*)(:?)([^:\n]*).*$', re.M)
+
+# Matches patterns made of a single type code with an optional count.
+_SINGLE_CODE_RE = re.compile(r'^(\d*)([^\d\ssp])$')
+
+# Sizes in bytes of format patterns that have already been seen.
+_CALCSIZE_CACHE = {}
+
+# Results of gen_format_string keyed by (tuple(formats), size, expand).
+_FORMAT_STRING_CACHE = {}
+_FORMAT_STRING_CACHE_MAXSIZE = 128
+
+
+def _calcsize(pattern):
+    """
+    Memoized struct.calcsize for a format pattern using standard sizes.
+    """
+    try:
+        return _CALCSIZE_CACHE[pattern]
+    except KeyError:
+        size = _CALCSIZE_CACHE[pattern] = struct.calcsize('=' + pattern)
+        return size
+
+
+def _repeat(pattern, count):
+    """
+    Repeat a format pattern count times, using the struct repeat count syntax
+    (eg, "1000h") instead of spelling out every copy when possible.
+    """
+    match = _SINGLE_CODE_RE.match(pattern)
+    if match is None or count == 1:
+        return count*pattern
+
+    num, code = match.groups()
+    return '{0}{1}'.format(int(num or 1)*count, code)
 
 
 def read_from_config_file(configfile):
@@ -19,8 +56,15 @@ def read_from_config_file(configfile):
         ["<pattern1>:<count1>", "<pattern2>:<count2>", ...]. Each instance of
         ":<countN>" can be omitted for format patterns that only occur once.
     """
+    # yaml is slow to import, so only do so when a config file is used.
+    import yaml
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+
     with open(configfile, 'r') as f:
-        formats = yaml.load(f)['formats']
+        formats = yaml.load(f, Loader=Loader)['formats']
 
     return formats
 
@@ -38,8 +82,99 @@ def write_to_config_file(configfile, formats):
         ["<pattern1>:<count1>", "<pattern2>:<count2>", ...]. Each instance of
         ":<countN>" can be omitted for format patterns that only occur once.
     """
+    import yaml
+    try:
+        from yaml import CSafeDumper as Dumper
+    except ImportError:
+        from yaml import SafeDumper as Dumper
+
     with open(configfile, 'w') as f:
-        yaml.dump({'formats': formats}, f, default_flow_style=False)
+        yaml.dump({'formats': formats}, f, Dumper=Dumper,
+                  default_flow_style=False)
+
+
+def gen_format_records(formats, size=None, expand=False):
+    """
+    Split a list of the form ["<pattern1>:<count1>", "<pattern2>:<count2>", ...]
+    into (pattern, count) records. For example,
+
+    >>> gen_format_records(["id4s:2", "f2d"])
+
+    would return [("id4s", 2), ("f2d", 1)]. This describes the same layout as
+    the format string made by gen_format_string without repeating patterns.
+
+    Parameters
+    ----------
+    formats : list of str
+        A list of strings of the form
+        ["<pattern1>:<count1>", "<pattern2>:<count2>", ...]. See
+        gen_format_string for details, including the special pound (#) count.
+    size : int, optional
+        size of the source file in bytes. Only needed if wilcard '#' character
+        is used in counts.
+    expand : bool, optional
+        If True, expand the pound in the formats list in place. See
+        gen_format_string for details.
+
+    Returns
+    -------
+    records : list of tuple
+        The (pattern, count) pair for each entry of formats. The count of the
+        pattern with a pound is None if size is None.
+    special_index : int or None
+        Index of the pattern with a pound count, if any.
+    """
+    # Split every "<pattern>:<count>" entry in a single regex scan.
+    entries = _FORMATS_RE.findall('\n'.join(formats)) if formats else []
+
+    special_indices = [i for i, (_, _, count) in enumerate(entries)
+                       if count.endswith('#')]
+    if len(special_indices) > 1:
+        raise struct.error('Pound (#) character may only be used once')
+    special_index = special_indices[0] if special_indices else None
+
+    # count is 1 if not given. Until remaining size is fully calculated, the
+    # count of the pound pattern is left as a placeholder.
+    records = [(pattern, None if i == special_index else
+                int(count) if colon else 1)
+               for i, (pattern, colon, count) in enumerate(entries)]
+
+    # Use this to keep track of size expended by format so far.
+    cumsize = sum(_calcsize(pattern)*count for pattern, count in records
+                  if count is not None)
+
+    # We are now ready to allocate the remaining bytes
+    # for the special '#' pattern.
+    if special_index is not None and size is not None:
+        special_pattern = records[special_index][0]
+
+        # Calculate the count such that pattern evenly fits in remaining size
+        remaining = size - cumsize
+        if remaining < 0:
+            raise struct.error('Format string size and chunk size do not '
+                               'match.\nExpected: {0}, Got: {1}'
+                               .format(size, cumsize))
+
+        chunksize = _calcsize(special_pattern)
+        count = remaining // chunksize
+        if remaining % chunksize != 0:
+            raise struct.error('Given chunksize of {0} bytes does not divide '
+                               'evenly into remaining number of bytes.'
+                               .format(chunksize))
+
+        records[special_index] = (special_pattern, count)
+        cumsize += chunksize*count
+
+        # Update formats list to expand # character.
+        if expand:
+            formats[special_index] = formats[special_index].replace('#', str(count))
+
+    # Final sanity check: Ensure format size and source file size match.
+    if size and size != cumsize:
+        raise struct.error('Format string size and chunk size do not match.\n'
+                           'Expected: {0}, Got: {1}'.format(size, cumsize))
+
+    return records, special_index
 
 
 def gen_format_string(formats, size=None, expand=False):
@@ -85,63 +220,30 @@ def gen_format_string(formats, size=None, expand=False):
         Formats list with pound count expanded to actual counts
         if expand is True.
     """
-    fmt = ''
-    # Use this to keep track of size expended by format so far.
-    cumsize = 0
-    special_pattern = None
-    special_index = None
-    for i, pattern_info in enumerate(formats):
-        pattern_info = pattern_info.split(':')
-        pattern = pattern_info[0]
-
-        # count is 1 if not given.
-        if len(pattern_info) == 1:
-            cumsize += struct.calcsize('=' + pattern)
-            fmt += pattern
-        elif pattern_info[1][-1] == '#':
-            if special_pattern:
-                raise struct.error('Pound (#) character may only be used once')
-
-            # We will need the current pattern and count values for later
-            # when the remaining size is fully calculated.
-            special_pattern = pattern
-            special_index = i
-
-            # Until remaining size is fully calculated, set a placeholder.
-            fmt += '{0}'
-        else:
-            count = int(pattern_info[1])
-            result = count*pattern
-            cumsize += struct.calcsize('=' + result)
-            fmt += result
-
-    # We are now ready to allocate the remaining bytes
-    # for the special '#' pattern.
-    if special_pattern:
-        # Make sure source is specified, otherwise return.
-        if size is None:
-            return fmt, formats
-
-        # Calculate the count such that pattern evenly fits in remaining size
-        remaining = size - cumsize
-        chunksize = struct.calcsize('=' + special_pattern)
-        count = remaining / chunksize
-        if remaining % chunksize != 0:
-            raise struct.error('Given chunksize of {0} bytes does not divide '
-                               'evenly into remaining number of bytes.'
-                               .format(chunksize))
-
-        result = count*special_pattern
-        fmt = fmt.format(result)
-
-        # Update formats list to expand # character.
-        if expand:
-            formats[special_index] = formats[special_index].replace('#', str(count))
-
-    # Final sanity check: Ensure format string size and source file size match.
-    fmt_size = struct.calcsize('=' + fmt)
-    if size and size != fmt_size:
-        raise struct.error('Format string size and chunk size do not match.\n'
-                           'Expected: {0}, Got: {1}'.format(size, fmt_size))
+    key = (tuple(formats), size, expand)
+    if key in _FORMAT_STRING_CACHE:
+        fmt, expanded = _FORMAT_STRING_CACHE[key]
+        # Only the pound expansion modifies formats in place.
+        if expand and tuple(formats) != expanded:
+            formats[:] = expanded
+        return fmt, formats
+
+    records, special_index = gen_format_records(formats, size, expand)
+
+    # Until remaining size is fully calculated, set a placeholder.
+    parts = ['{0}' if count is None else _repeat(pattern, count)
+             for pattern, count in records]
+
+    # Make sure source is specified, otherwise return.
+    if special_index is not None and size is None:
+        return ''.join(parts), formats
+
+    # gen_format_records has already checked the size of the records, so
+    # there is no need to parse fmt again to check it.
+    fmt = ''.join(parts)
+
+    if len(_FORMAT_STRING_CACHE) >= _FORMAT_STRING_CACHE_MAXSIZE:
+        _FORMAT_STRING_CACHE.clear()
+    _FORMAT_STRING_CACHE[key] = (fmt, tuple(formats))
 
     return fmt, formats
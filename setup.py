@@ -31,6 +31,12 @@ setup(
     url =             	'https://github.com/agoodm/binconvert',
     platforms =         ['any'],
     install_requires =  ['pyyaml'],
+    extras_require =    {
+        'numpy': ['numpy>=1.20; python_version >= "3.7"',
+                  'numpy; python_version < "3.7"'],
+        'numba': ['numpy>=1.20; python_version >= "3.7"',
+                  'numpy; python_version < "3.7"', 'numba'],
+    },
     license =           'MIT',
     tests_require  =    ['nose'],
     test_suite =        'nose.collector',